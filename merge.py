@@ -1,6 +1,7 @@
-from csv import DictReader, DictWriter
+import csv
 from requests import post, RequestException
 from time import sleep
+from rate_limit import MAX_RETRIES, retry_delay, call_interval
 
 """
 	SELECT DISTINCT ON (TRIM(name))
@@ -17,46 +18,84 @@ INPUT_FILE  = "clades.csv"
 OUTPUT_FILE = "clades-with-ott-id.csv"
 API_URL = "https://api.opentreeoflife.org/v3/tnrs/match_names"
 BATCH_SIZE = 100
+MIN_DELAY = 0.5 # Seconds between API calls, at least.
 
+def next_delay(response):
+	# Seconds to wait before the next call, following the API's rate limit
+	# headers if it sends them, see call_interval.
+	interval = call_interval(response.headers)
+	return MIN_DELAY if interval is None else max(MIN_DELAY, interval)
+
+# Only the names still missing an ott_id are kept in memory, not the rows.
 with open(INPUT_FILE, newline="", encoding="utf-8") as file:
 	print(f"Loading {INPUT_FILE}")
-	clades = list(DictReader(file))
-	print(f"Loaded {len(clades)} clades")
+	reader = csv.reader(file)
+	header = next(reader)
+	name_col = header.index("name")
+	ott_id_col = header.index("ott_id") if "ott_id" in header else None
+	count = 0
+	names = {} # Used as an ordered set, since names may repeat.
+	for row in reader:
+		if not row:
+			continue # Skip blank lines, as DictReader did.
+		count += 1
+		if ott_id_col is None or not row[ott_id_col]:
+			names[row[name_col]] = None
+	names = list(names)
+	print(f"Loaded {count} clades")
 
-row_lookup = {c["name"]: i for i, c in enumerate(clades) if not c.get("ott_id")}
-total = len(row_lookup.keys())
+total = len(names)
 print(f"Looking up ott_id for {total} clades")
 
 # Look up clades in batches using the Open Tree of Life API.
 # See https://github.com/OpenTreeOfLife/germinator/wiki/TNRS-API-v3#match_names
 stats = [0, 0, 0]
-names = list(row_lookup.keys())
+ott_ids = {}
 for i in range(0, total, BATCH_SIZE):
 	percent = (i / total) * 100
 	print(f"   Processed {i} of {total} ({percent:.2f}%)", end="\r", flush=True)
 	try:
-		response = post(API_URL, json={"names": names[i:i + BATCH_SIZE]}, timeout=10)
+		for attempt in range(MAX_RETRIES):
+			response = post(API_URL, json={"names": names[i:i + BATCH_SIZE]}, timeout=10)
+			if response.status_code not in (429, 503): # Too many requests, or overloaded.
+				break
+			if attempt < MAX_RETRIES - 1: # No need to wait if we're giving up.
+				sleep(retry_delay(response, attempt))
 		response.raise_for_status()
 		result = response.json()
 	except RequestException as e:
 		print(f"\nAPI call failed: {e}")
 		exit(1)
 	for clade in result["results"]:
-		row = clades[row_lookup[clade["name"]]]
 		if len(clade["matches"]) == 0:
-			row["ott_id"] = -1
+			ott_ids[clade["name"]] = -1
 			stats[1] += 1 # No matches
 		elif len(clade["matches"]) > 1:
-			row["ott_id"] = -2
+			ott_ids[clade["name"]] = -2
 			stats[2] += 1 # Multiple matches
 		else:
-			row["ott_id"] = clade["matches"][0]["taxon"]["ott_id"]
+			ott_ids[clade["name"]] = clade["matches"][0]["taxon"]["ott_id"]
 			stats[0] += 1 # Scucessful lookup
-	sleep(0.5) # Respectful API call velocity.
+	if i + BATCH_SIZE < total: # No need to wait after the last call.
+		sleep(next_delay(response)) # Respectful API call velocity.
 
 print(f"Found {stats[0]}, missing {stats[1]}, ambiguous {stats[2]}")
 
-with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as file:
-	writer = DictWriter(file, fieldnames=clades[0].keys())
-	writer.writeheader()
-	writer.writerows(clades)
+# Read the input a second time, writing each row out as soon as it is merged.
+with open(INPUT_FILE, newline="", encoding="utf-8") as input_file, \
+		open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as output_file:
+	reader = csv.reader(input_file)
+	writer = csv.writer(output_file)
+	next(reader) # Header, same as above.
+	if ott_id_col is None:
+		ott_id_col = len(header)
+		header.append("ott_id")
+	writer.writerow(header)
+	for row in reader:
+		if not row:
+			continue # Skip blank lines, as DictReader did.
+		if ott_id_col == len(row):
+			row.append("")
+		if not row[ott_id_col]: # Leave ids already in the input alone.
+			row[ott_id_col] = ott_ids.get(row[name_col], "")
+		writer.writerow(row)
@@ -1,13 +1,19 @@
 import re
 import csv
 import json
+import zlib
 import sqlite3
 from sys import exit
-from time import sleep
+from time import monotonic
 from pathlib import Path
-from urllib import request
+from mmap import mmap, ACCESS_READ
+from threading import Lock, Event
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from itertools import islice, chain
+from collections import deque
 from urllib.request import urlretrieve
-from Bio import Phylo
+from requests import Session, RequestException
+from rate_limit import MAX_RETRIES, MAX_DELAY, retry_delay, call_interval
 
 OTT_RELEASE = "15.1" # See https://files.opentreeoflife.org/synthesis/
 OTT_API_URL = "https://api.opentreeoflife.org/v3"
@@ -15,6 +21,55 @@ OTT_TREE_URL = f'https://files.opentreeoflife.org/synthesis/opentree{OTT_RELEASE
 OTT_TREE_FILE = Path(f"tree-{OTT_RELEASE}.tre")
 DB_FILE = Path(f"taxa-{OTT_RELEASE}.db")
 SCHEMA = ["id", "parent", "name", "extant", "other_names", "description"]
+WORKERS = 8 # Number of API calls in flight at once.
+QUEUE_SIZE = 64 # Lookups queued ahead of the database writes.
+RATE_LIMIT = 2 # Maximum API calls per second, shared by all workers.
+BATCH_SIZE = 1000 # Taxa per database transaction.
+UNKNOWN_TAXON = "Unknown Taxon" # Name given to composite labels, which aren't in the OTT dataset.
+INSERT_SIZE = 499 # Taxa per INSERT statement, within SQLite's limit of 999 parameters.
+# Preset dictionary for compressing the tax_sources and synonyms lists, which are mostly
+# too short to compress well on their own. Common source prefixes, most common last.
+# Changing this makes existing databases unreadable.
+LIST_ZDICT = b'"silva:", "if:", "worms:", "irmng:", "gbif:", "ncbi:'
+
+# Shared by all API calls so connections to the API are kept alive and reused.
+session = Session()
+
+class RateLimiter:
+	# Spaces out API calls made from several threads so that, taken together,
+	# they never exceed the given number of calls per second.
+	def __init__(self, rate):
+		self.min_interval = 1 / rate
+		self.interval = self.min_interval
+		self.next_call = monotonic()
+		self.lock = Lock()
+		self.stopped = Event()
+
+	def acquire(self):
+		with self.lock:
+			now = monotonic()
+			wait = self.next_call - now
+			self.next_call = max(now, self.next_call) + self.interval
+		# Waiting on the event rather than sleeping lets stop() wake every thread.
+		if self.stopped.wait(max(wait, 0)):
+			raise CancelledError()
+
+	def stop(self):
+		# Cancel all waiting and future calls, e.g. when the script is aborted.
+		self.stopped.set()
+
+	def pause(self, seconds):
+		# Hold back every thread's next call, e.g. when the API returns Retry-After.
+		with self.lock:
+			self.next_call = max(self.next_call, monotonic() + min(seconds, MAX_DELAY))
+
+	def update(self, headers):
+		# Follow the API's rate limit headers, if it sends them, see call_interval.
+		# Never exceed our own rate.
+		interval = call_interval(headers)
+		if interval is not None:
+			with self.lock:
+				self.interval = max(self.min_interval, interval)
 
 def download_tree():
 	# Download the opentreeoflife.org phylogenetic tree of life.
@@ -34,91 +89,241 @@ def download_tree():
 		exit(1) # This is a fatal error.
 
 def process_tree():
-	# Flatten the phylogenetic tree of life into a list, one item per taxon.
+	# Flatten the phylogenetic tree of life into (taxon, parent) rows, one per taxon.
 	# Data from opentreeoflife.org is formatted as a Newick tree string.
+	# Rows are generated while reading the file, so the tree is never held in memory.
+	# A clade's label follows its children, e.g. "((a,b)c,d)e;", so the labels of
+	# the children of each open clade are held until it is closed and named.
 	print("Processing tree")
-	taxa = []
-	tree = Phylo.read(OTT_TREE_FILE, "newick")
-	stack = [(None, tree.root)]
-	while stack:
-		parent, clade = stack.pop()
-		if clade.name:
-			taxa.append((clade.name, parent))
-		for child in clade.clades:
-			stack.append((clade.name, child))
-	return taxa
+	delimiters = re.compile(rb"([(),;])")
+	stack = [[]] # Child labels of each open clade, from the root down.
+	closed = [] # Child labels of the clade just closed, waiting for its label.
+	label = b"" # Bytes after the last delimiter, which may continue in the next chunk.
+	# The file is memory mapped and scanned as bytes, so the operating system pages it
+	# in as needed and only the labels themselves are ever decoded into strings.
+	with open(OTT_TREE_FILE, "rb") as file, mmap(file.fileno(), 0, access=ACCESS_READ) as tree:
+		for offset in range(0, len(tree), 1 << 20):
+			# Splitting on the delimiters scans the bytes in C, giving
+			# alternating label and delimiter tokens.
+			tokens = delimiters.split(label + tree[offset:offset + (1 << 20)])
+			label = tokens.pop()
+			tokens = iter(tokens)
+			for text, char in zip(tokens, tokens):
+				if char == b"(":
+					stack.append([])
+					continue
+				name = text.split(b":")[0].strip().decode("utf-8") # Drop any branch length.
+				for child in closed:
+					yield child, name or None
+				if name:
+					stack[-1].append(name)
+				closed = stack.pop() if char == b")" else []
+				if char == b";":
+					for root in stack.pop():
+						yield root, None
 
 def db_exists(conn):
 	return bool(conn.execute("PRAGMA table_info(taxa);").fetchone())
 
 def db_create(conn, taxa):
-	# Taxa list is saved to a SQLite3 database at DB_FILE e.g. taxa-15.1.db
+	# Taxa rows are saved to a SQLite3 database at DB_FILE e.g. taxa-15.1.db
 	# At this point we only have relationships without any details.
 	# Table creation will rollback if an exception is raised inside the "with" block.
 	print("Creating database")
 	with conn:
 		conn.execute("""
 			CREATE TABLE IF NOT EXISTS taxa (
-				id     TEXT PRIMARY KEY,
-				parent TEXT,
-				info   TEXT DEFAULT NULL
+				id          TEXT PRIMARY KEY,
+				parent      TEXT,
+				name        TEXT DEFAULT NULL,
+				extant      INTEGER DEFAULT NULL,
+				rank        TEXT DEFAULT NULL,
+				tax_sources BLOB DEFAULT NULL,
+				synonyms    BLOB DEFAULT NULL
 			)
 		""")
-		conn.executemany("INSERT INTO taxa (id, parent) VALUES (?, ?)", taxa)
+		# Insert many rows per statement. Every full chunk uses the same SQL, so it's
+		# only prepared once; just the last, shorter chunk needs its own statement.
+		taxa = iter(taxa)
+		while chunk := list(islice(taxa, INSERT_SIZE)):
+			values = ", ".join(["(?, ?)"] * len(chunk))
+			conn.execute(f"INSERT INTO taxa (id, parent) VALUES {values}", list(chain.from_iterable(chunk)))
+		# Index the taxa still to be looked up, so resuming doesn't scan the whole table.
+		# Rows drop out of this index as they are looked up. It's created after the
+		# inserts above so the initial load doesn't pay for index maintenance.
+		conn.execute("CREATE INDEX IF NOT EXISTS idx_taxa_pending ON taxa (id) WHERE name IS NULL")
+
+def db_migrate(conn):
+	# Older databases kept each API response as JSON in an "info" column.
+	# Move those into the typed columns, so the lookups can carry on from there.
+	# Composite labels are left pending; lookup_taxa names them without the API.
+	# Migration will rollback if an exception is raised inside the "with" block.
+	# Without DROP COLUMN, a migrated database keeps an empty "info" column.
+	columns = [column for _, column, *_ in conn.execute("PRAGMA table_info(taxa);")]
+	if "info" not in columns or "name" in columns:
+		return
+	print("Migrating database")
+	with conn:
+		conn.execute("BEGIN") # Include the schema changes in the transaction.
+		conn.execute("DROP INDEX IF EXISTS idx_taxa_pending")
+		for column, kind in [("name", "TEXT"), ("extant", "INTEGER"), ("rank", "TEXT"),
+				("tax_sources", "BLOB"), ("synonyms", "BLOB")]:
+			conn.execute(f"ALTER TABLE taxa ADD COLUMN {column} {kind} DEFAULT NULL")
+		query = """
+			SELECT id, info FROM taxa WHERE info IS NOT NULL
+			AND id GLOB 'ott[0-9]*' AND id NOT GLOB 'ott*[^0-9]*'
+			AND id > ? ORDER BY id LIMIT ?
+		"""
+		last_id = ""
+		while page := conn.execute(query, (last_id, BATCH_SIZE)).fetchall():
+			last_id = page[-1][0]
+			conn.executemany(
+				"UPDATE taxa SET name=?, extant=?, rank=?, tax_sources=?, synonyms=? WHERE id=?",
+				[taxon_row(taxon_id, json.loads(info)) for taxon_id, info in page]
+			)
+		if sqlite3.sqlite_version_info >= (3, 35, 0):
+			conn.execute("ALTER TABLE taxa DROP COLUMN info")
+		else:
+			conn.execute("UPDATE taxa SET info=NULL") # DROP COLUMN isn't supported.
+		conn.execute("CREATE INDEX idx_taxa_pending ON taxa (id) WHERE name IS NULL")
+
+def fetch_taxon(limiter, taxon_id):
+	# Look up a single taxon using the API. This runs on a worker thread,
+	# so it must not touch the database connection.
+	url = f"{OTT_API_URL}/taxonomy/taxon_info"
+	for attempt in range(MAX_RETRIES):
+		limiter.acquire() # Respectful API call velocity.
+		response = session.post(url, json={"ott_id": int(taxon_id[3:])}, timeout=10)
+		limiter.update(response.headers)
+		if response.status_code not in (429, 503): # Too many requests, or overloaded.
+			break
+		if attempt < MAX_RETRIES - 1: # Don't hold back the other workers if we're giving up.
+			limiter.pause(retry_delay(response, attempt))
+	response.raise_for_status()
+	return taxon_id, response.json()
+
+def pack_list(values):
+	# Lists are stored as JSON, compressed with raw deflate (zlib wbits=-15) and
+	# LIST_ZDICT. Read them back with zlib.decompressobj(-15, zdict=LIST_ZDICT).
+	# Empty lists, e.g. most synonyms, are stored as NULL.
+	if not values:
+		return None
+	compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=LIST_ZDICT)
+	return compressor.compress(json.dumps(values).encode("utf-8")) + compressor.flush()
+
+def taxon_row(taxon_id, taxon_info):
+	# Pick out the fields we keep from an API response, in the order of the
+	# UPDATE in lookup_taxa. Lists are compressed, see pack_list.
+	flags = taxon_info.get("flags", [])
+	return (
+		taxon_info["name"],
+		int(not any(flag.startswith("extinct") for flag in flags)),
+		taxon_info.get("rank"),
+		pack_list(taxon_info.get("tax_sources", [])),
+		pack_list(taxon_info.get("synonyms", [])),
+		taxon_id
+	)
+
+def pending_taxa(conn):
+	# Generate the ids of taxa still to be looked up, a page at a time.
+	# Pages are keyed by id rather than holding one cursor open, since
+	# lookup_taxa removes rows from the index that cursor would be reading.
+	query = "SELECT id FROM taxa WHERE name IS NULL AND id > ? ORDER BY id LIMIT ?"
+	last_id = ""
+	while page := conn.execute(query, (last_id, BATCH_SIZE)).fetchall():
+		last_id = page[-1][0]
+		for (taxon_id,) in page:
+			yield taxon_id
+
+def fetch_taxa(executor, limiter, taxon_ids):
+	# Generate API lookups in order, keeping up to QUEUE_SIZE of them queued on
+	# the worker threads so they carry on while the caller saves results.
+	queue = deque()
+	for taxon_id in taxon_ids:
+		queue.append(executor.submit(fetch_taxon, limiter, taxon_id))
+		if len(queue) >= QUEUE_SIZE:
+			yield queue.popleft().result()
+	while queue:
+		yield queue.popleft().result()
 
 def lookup_taxa(conn):
 	# Use the opentreeoflife.org API to get lookup each taxon.
 	# See https://github.com/OpenTreeOfLife/germinator/wiki/Open-Tree-of-Life-Web-APIs
+	# Worker threads make the API calls, several at once to hide network latency,
+	# while the main thread saves their results; the database is only used here.
 	print("Looking up taxa...")
-	url = f"{OTT_API_URL}/taxonomy/taxon_info"
-	opener = request.build_opener(request.HTTPSHandler())
-	headers = {"Content-Type": "application/json"}
-	pattern = re.compile(r"^ott\d+$")
-	total = conn.execute("SELECT COUNT(*) FROM taxa WHERE info IS NULL").fetchone()[0]
-	new_taxa = conn.execute("SELECT id FROM taxa WHERE info IS NULL")
-	for index, (taxon_id,) in enumerate(new_taxa, start=1):
-
-		# Show progress in the console.
-		percent = (index / total) * 100
-		print(f"   Processing taxon {index} of {total} ({percent:.2f}%)", end="\r", flush=True)
-
-		# Avoid entries with a composite label i.e. it's not in the OTT dataset.
-		if not pattern.match(taxon_id):
-			conn.execute(
-				"UPDATE taxa SET info=? WHERE id=?",
-				(json.dumps({"name": "Unknown Taxon"}), taxon_id)
-			)
-			continue
+	limiter = RateLimiter(RATE_LIMIT)
+	update = "UPDATE taxa SET name=?, extant=?, rank=?, tax_sources=?, synonyms=? WHERE id=?"
 
-		# Look up data using the API and save the results to our database.
-		payload = json.dumps({"ott_id": int(taxon_id[3:])}).encode("utf-8")
-		req = request.Request(url, data=payload, headers=headers)
-		with opener.open(req) as response:
-			if response.status == 200:
-				taxon_info = json.loads(response.read().decode("utf-8"))
-				conn.execute(
-					"UPDATE taxa SET info=? WHERE id=?",
-					(json.dumps(taxon_info), taxon_id)
-				)
+	# Avoid entries with a composite label i.e. it's not in the OTT dataset.
+	# Only labels matching ^ott\d+$ are left for the API calls below.
+	with conn:
+		conn.execute("""
+			UPDATE taxa SET name=? WHERE name IS NULL
+			AND (id NOT GLOB 'ott[0-9]*' OR id GLOB 'ott*[^0-9]*')
+		""", (UNKNOWN_TAXON,))
+
+	total = conn.execute("SELECT COUNT(*) FROM taxa WHERE name IS NULL").fetchone()[0]
+	executor = ThreadPoolExecutor(max_workers=WORKERS)
+	cur = conn.cursor() # Reused for every batch, so its statement is only prepared once.
+	pending = []
+	write_failed = False
+	try:
+		results = fetch_taxa(executor, limiter, pending_taxa(conn))
+		for index, (taxon_id, taxon_info) in enumerate(results, start=1):
 
-		# Commit in batches of 100 i.e. about every minute.
-		if index % 100 == 0:
-			conn.commit()
+			# Show progress in the console.
+			percent = (index / total) * 100
+			print(f"   Processing taxon {index} of {total} ({percent:.2f}%)", end="\r", flush=True)
 
-		sleep(0.5) # Respectful API call velocity.
+			# Save results to our database in batches, each a single transaction.
+			# The transaction will commit when the "with" block ends.
+			pending.append(taxon_row(taxon_id, taxon_info))
+			if len(pending) >= BATCH_SIZE:
+				try:
+					with conn:
+						cur.executemany(update, pending)
+				except sqlite3.Error:
+					write_failed = True # Don't retry it below and hide this error.
+					raise
+				pending.clear()
+	finally:
+		try:
+			# Save the last partial batch first, even if aborted or an API call failed,
+			# so those taxa aren't looked up again when the script is resumed.
+			if not write_failed:
+				with conn:
+					cur.executemany(update, pending)
+		finally:
+			limiter.stop() # Wake any workers waiting on the limiter, so shutdown is quick.
+			executor.shutdown(cancel_futures=True) # Don't wait on queued lookups if aborted.
 
 def main():
 	conn = sqlite3.connect(DB_FILE)
-	conn.execute("PRAGMA journal_mode=WAL;")
+	# With WAL, synchronous=NORMAL skips the fsync on every commit. A power loss
+	# or crash may lose the last committed batch, but cannot corrupt the database,
+	# and the script simply looks those taxa up again when it resumes.
+	conn.executescript("""
+		PRAGMA journal_mode=WAL;
+		PRAGMA synchronous=NORMAL;
+		PRAGMA temp_store=MEMORY;
+		PRAGMA mmap_size=268435456;
+		PRAGMA cache_size=-65536;
+		PRAGMA cache_spill=0;
+	""")
 	if not db_exists(conn):
 		download_tree()
 		taxa = process_tree()
 		db_create(conn, taxa)
+	db_migrate(conn)
 	try:
 		lookup_taxa(conn)
 	except KeyboardInterrupt:
 		print('\nAborted!')
 		exit(130) # Our job is incomplete, but the script can be safely run again to resume.
+	except RequestException as e:
+		print(f"\nAPI call failed: {e}")
+		exit(1) # The script can be safely run again to resume.
 	conn.close()
 	print("Done!")
 
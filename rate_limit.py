@@ -0,0 +1,28 @@
+from time import time
+
+# Pacing for calls to the opentreeoflife.org API, shared by ott.py and merge.py.
+
+MAX_RETRIES = 5 # Attempts per API call when the API asks us to slow down.
+MAX_DELAY = 60 # Longest wait in seconds we'll accept from the API's rate limit headers.
+
+def retry_delay(response, attempt):
+	# Seconds to wait before retrying a call the API turned away. Use its
+	# Retry-After header if given, otherwise back off exponentially.
+	try:
+		return min(float(response.headers["Retry-After"]), MAX_DELAY)
+	except (KeyError, ValueError):
+		return min(2 ** attempt, MAX_DELAY)
+
+def call_interval(headers):
+	# Seconds between calls that spreads the calls the API says we have left
+	# over the time until its limit resets, or None if it doesn't send those
+	# headers. The reset is usually seconds from now, but some APIs send a
+	# Unix timestamp instead.
+	try:
+		remaining = int(headers["X-RateLimit-Remaining"])
+		reset = float(headers["X-RateLimit-Reset"])
+	except (KeyError, ValueError):
+		return None
+	if reset > 1e9: # Only a Unix timestamp is this large, i.e. after September 2001.
+		reset = max(reset - time(), 0)
+	return min(reset / max(remaining, 1), MAX_DELAY)